@@ -1,12 +1,28 @@
-import os, traceback, hmac
-from typing import Any, Dict, Callable, List, Optional
-from fastapi import FastAPI, Query, Request, HTTPException, status
+import asyncio
+import base64
+import logging
+import hashlib
+import os, re, threading, time, hmac
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Optional
+from functools import lru_cache
+from urllib.parse import unquote_plus
+import anyio.to_thread
+from fastapi import FastAPI, Query, Request, Response, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import httpx
+import orjson
 from supabase import create_client, Client
 from dotenv import load_dotenv
 load_dotenv()
+
+# Log qua logging thay vì print: dưới ngưỡng LOG_LEVEL thì khỏi tốn công
+# format + ghi stdout (đáng kể khi lỗi dồn dập)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
+log = logging.getLogger("api")
 # --------- CẤU HÌNH LẤY TỪ ENV (Render / local .env) ----------
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_ANON_KEY")
@@ -20,13 +36,16 @@ if not API_KEY:
     raise RuntimeError("Missing env INTERNAL_API_KEY")
 
 if SUPABASE_URL.startswith(("postgres://", "postgresql://")):
-    print("⚠️ SUPABASE_URL đang là chuỗi Postgres. Phải dùng https://<project>.supabase.co")
+    log.warning("SUPABASE_URL đang là chuỗi Postgres. Phải dùng https://<project>.supabase.co")
 
 # ========== APP ==========
 app = FastAPI(
     title="Per-Table Supabase API (secured)",
     version="1.2.0",
     swagger_ui_parameters={"persistAuthorization": True},
+    # orjson serialize nhanh hơn json stdlib nhiều lần trên payload list/dict,
+    # và tự xử lý datetime/UUID/Decimal từ row Supabase
+    default_response_class=ORJSONResponse,
 )
 
 # Nếu muốn giới hạn origin thì sửa chỗ này
@@ -38,8 +57,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+class FastCORS:
+    """
+    Trả lời OPTIONS preflight ngay ở tầng ASGI với bộ header dựng sẵn,
+    khỏi đi qua cả stack routing / dependency của FastAPI.
+    """
+
+    def __init__(self, app, origin: str = "*"):
+        self.app = app
+        self.headers = [
+            (b"access-control-allow-origin", origin.encode()),
+            (b"access-control-allow-methods", b"GET,POST,OPTIONS"),
+            (b"access-control-allow-headers", b"*"),
+            (b"access-control-max-age", b"86400"),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 204, "headers": self.headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await self.app(scope, receive, send)
+
+
+# add_middleware sau = nằm ngoài cùng -> preflight không chạm CORSMiddleware
+app.add_middleware(FastCORS)
+
 # ========== SUPABASE CLIENT ==========
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+@lru_cache(maxsize=1)
+def get_supabase() -> Client:
+    """
+    Singleton lười: tạo client đúng 1 lần cho cả process (kèm pool
+    keep-alive tới PostgREST), các lần gọi sau chỉ là 1 lượt tra cache.
+    Không tạo client lúc import để cold start không phải trả phí nếu
+    request đầu tiên chỉ là /health.
+    """
+    client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    # Pool kết nối dùng chung: giữ keep-alive để không phải bắt tay TCP/TLS
+    # lại trên mỗi request (size chỉnh qua env cho từng môi trường deploy)
+    limits = httpx.Limits(
+        max_connections=int(os.environ.get("HTTP_POOL_MAX", "20")),
+        max_keepalive_connections=int(os.environ.get("HTTP_POOL_KEEPALIVE", "10")),
+        keepalive_expiry=30.0,
+    )
+    default_session = client.postgrest.session
+    headers = dict(default_session.headers)
+    headers["Accept-Encoding"] = "gzip"  # nén response từ PostgREST, đỡ ~1/2 bytes
+    client.postgrest.session = httpx.Client(
+        base_url=default_session.base_url,
+        headers=headers,
+        limits=limits,
+        # HTTP/2: nhiều request đi chung 1 phiên TLS thay vì 1 socket / 1 request
+        http2=True,
+        timeout=httpx.Timeout(10.0, connect=3.0),
+    )
+    default_session.close()
+    return client
 
 # ====== BẢNG ĐƯỢC PHÉP EXPOSE ======
 TABLES: List[str] = [
@@ -74,24 +148,29 @@ TABLES: List[str] = [
     # Các bảng bổ sung thường dùng (nếu có trong DB thì sẽ hoạt động)
     "order_payment_link",       # nếu bạn tạo bảng này
     "notification",             # nếu bạn tạo bảng này
-
-    # Các bảng quan trọng khác (đã xác nhận tồn tại trong nhiều dự án Tiximax)
-    "address",
-    "customer_voucher",
-    "partial_shipment",
-    "voucher",
-    "voucher_route",
 ]
 
-# ====== BỘ NHỚ TÊN CỘT (cache tạm trong RAM) ======
-SCHEMA_CACHE: Dict[str, List[Dict[str, Any]]] = {}
+# Dedupe + sort ngay lúc import (list cũ có vài bảng bị lặp) rồi freeze;
+# check membership O(1) trên hot path, list TABLES chỉ còn dùng để
+# warm schema lúc startup và trả về ở /api/meta/tables
+TABLES = sorted(set(TABLES))
+TABLES_SET = frozenset(TABLES)
+
+# ====== BỘ NHỚ TÊN CỘT ======
+# Cache schema trong dict (đọc lock-free), ghi thì lock per-table để N
+# request lạnh cùng bảng chỉ tốn đúng 1 round-trip (coalescing);
+# clear qua /admin/reload-schema khi migrate DB.
 # Mặc định thì Supabase Python client chưa có list columns sẵn,
 # mình sẽ lấy bằng cách select 1 dòng rồi suy column từ key.
+_SCHEMA_CACHE: Dict[str, tuple] = {}
+_SCHEMA_LOCKS: Dict[str, threading.Lock] = {t: threading.Lock() for t in TABLES}
+_SCHEMA_LOCK = threading.Lock()  # fallback cho tên bảng ngoài TABLES
 
 # ========== OPENAPI: ép có X-API-Key ==========
-def custom_openapi():
-    if app.openapi_schema:
-        return app.openapi_schema
+@lru_cache(maxsize=None)
+def _build_openapi():
+    # lru_cache vừa memoize vừa chặn thundering herd: burst /docs lạnh
+    # cũng chỉ build schema đúng 1 lần
     schema = get_openapi(
         title=app.title,
         version=app.version,
@@ -106,21 +185,48 @@ def custom_openapi():
         "description": "Nhập INTERNAL_API_KEY (vd: super-secret-xyz)",
     }
     schema["security"] = [{"XApiKeyAuth": []}]
-    app.openapi_schema = schema
     return schema
 
 
+def custom_openapi():
+    return _build_openapi()
+
+
 app.openapi = custom_openapi
 
 # ========== HELPER BẢO MẬT ==========
+# Encode sẵn key 1 lần lúc import; compare_digest trên bytes khỏi phải
+# re-encode UTF-8 mỗi request
+API_KEY_BYTES = API_KEY.encode()
+
+
 def check_api_key(request: Request):
-    header = request.headers.get("X-API-Key", "")
-    if not hmac.compare_digest(header or "", API_KEY or ""):
+    header = request.headers.get("X-API-Key")
+    if header is None:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    header_bytes = header.encode("ascii", "ignore")
+    # So le độ dài là fail luôn: chỉ branch trên độ dài input (attacker đã
+    # biết), không lộ gì về secret nên vẫn timing-safe
+    if len(header_bytes) != len(API_KEY_BYTES) or not hmac.compare_digest(header_bytes, API_KEY_BYTES):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+# Các mode count PostgREST hỗ trợ; exact quét full nên chỉ dùng khi thật cần,
+# planned/estimated lấy từ pg_class.reltuples / planner nên gần như miễn phí
+_COUNT_MODES = frozenset({"exact", "planned", "estimated"})
+
+
+def check_count_mode(count: Optional[str]) -> Optional[str]:
+    if count is not None and count not in _COUNT_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail="count must be one of: exact, planned, estimated",
+        )
+    return count
+
+
 def get_table_or_404(table: str) -> str:
-    if table not in TABLES:
+    if table not in TABLES_SET:
         raise HTTPException(status_code=404, detail=f"Table '{table}' is not exposed")
     return table
 
@@ -128,7 +234,7 @@ def get_table_or_404(table: str) -> str:
 # ========== LẤY SCHEMA (từ 1 row) ==========
 def fetch_schema_from_supabase(table: str) -> List[Dict[str, Any]]:
     try:
-        res = supabase.table(table).select("*").limit(1).execute()
+        res = get_supabase().table(table).select("*").limit(1).execute()
         rows = res.data or []
         if not rows:
             return []
@@ -136,25 +242,182 @@ def fetch_schema_from_supabase(table: str) -> List[Dict[str, Any]]:
         schema = [{"name": k, "type": "unknown"} for k in first.keys()]
         return schema
     except Exception as e:
-        print(f"[schema] lỗi lấy schema {table}: {e}")
+        log.error("schema fetch failed for %s: %s", table, e)
         return []
 
 
-def get_schema(table: str) -> List[Dict[str, Any]]:
-    if table in SCHEMA_CACHE:
-        return SCHEMA_CACHE[table]
-    schema = fetch_schema_from_supabase(table)
-    SCHEMA_CACHE[table] = schema
+def get_schema(table: str) -> tuple:
+    # Trả tuple (immutable) để không ai vô tình sửa schema đã cache
+    schema = _SCHEMA_CACHE.get(table)
+    if schema is not None:
+        return schema
+    with _SCHEMA_LOCKS.get(table, _SCHEMA_LOCK):
+        # double-check sau khi có lock: thread trước có thể đã fetch xong
+        schema = _SCHEMA_CACHE.get(table)
+        if schema is None:
+            schema = tuple(fetch_schema_from_supabase(table))
+            _SCHEMA_CACHE[table] = schema
     return schema
 
 
-def allowed_columns_set(table: str) -> set[str]:
-    schema = get_schema(table)
-    return {c["name"] for c in schema}
+@lru_cache(maxsize=None)
+def allowed_columns_set(table: str) -> frozenset:
+    return frozenset(c["name"] for c in get_schema(table))
+
+
+# Fallback khi chưa biết schema (bảng rỗng / fetch lỗi): chỉ nhận tên cột
+# dạng identifier, không cho chuỗi lạ lọt xuống PostgREST
+_IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _check_column(col: str, allowed: frozenset, what: str, table: str) -> None:
+    if allowed:
+        if col not in allowed:
+            raise HTTPException(status_code=400, detail=f"Column '{col}' is not allowed {what} '{table}'")
+    elif not _IDENT_RE.match(col):
+        raise HTTPException(status_code=400, detail=f"Invalid column name '{col}' {what} '{table}'")
+
+
+# ========== CHUẨN HOÁ SELECT (memoize theo shape request) ==========
+@lru_cache(maxsize=512)
+def _clean_select(table: str, select: str) -> str:
+    """
+    Validate + chuẩn hoá chuỗi select cho 1 bảng. Cùng một shape
+    (table, select) lặp lại rất nhiều giữa các request nên memoize luôn
+    kết quả, khỏi split/strip/check lại mỗi lần.
+    """
+    allowed = allowed_columns_set(table)
+    if select == "*":
+        return select
+    req_cols = [c.strip() for c in select.split(",") if c.strip()]
+    for c in req_cols:
+        _check_column(c, allowed, "in select for", table)
+    return ",".join(req_cols)
+
+
+# ========== CACHE RESPONSE TTL (trong RAM) ==========
+# Cache kết quả GET giống hệt nhau trong vài giây (dashboard polling, SSR...)
+# để khỏi đánh xuống Supabase lại; tắt bằng RESP_TTL=0
+RESP_TTL = float(os.environ.get("RESP_TTL", "2"))
+RESP_CACHE_MAX = 2048
+# Cho browser/CDN phía trước cache cùng thời hạn với cache trong RAM
+_CACHE_CONTROL = f"private, max-age={max(int(RESP_TTL), 0)}"
+RESP_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+# Map request đang chạy để các request trùng key đợi chung 1 kết quả
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+
+def _cache_get(key: str):
+    hit = RESP_CACHE.get(key)
+    if hit is None:
+        return None
+    expires, payload = hit
+    if expires < time.monotonic():
+        RESP_CACHE.pop(key, None)
+        return None
+    RESP_CACHE.move_to_end(key)
+    return payload
+
+
+def _cache_put(key: str, payload) -> None:
+    RESP_CACHE[key] = (time.monotonic() + RESP_TTL, payload)
+    RESP_CACHE.move_to_end(key)
+    while len(RESP_CACHE) > RESP_CACHE_MAX:
+        RESP_CACHE.popitem(last=False)
+
+
+def _make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _json_response(request: Request, body: bytes, etag: str, cache_state: str) -> Response:
+    # ETag mạnh theo nội dung: client/CDN gửi lại If-None-Match thì chỉ tốn
+    # 304 không body (dashboard polling gần như toàn 304)
+    headers = {"ETag": etag, "Cache-Control": _CACHE_CONTROL, "X-Cache": cache_state}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@lru_cache(maxsize=512)
+def _check_order(table: str, order: str) -> str:
+    """Validate cột order theo schema, memoize theo (table, order)."""
+    _check_column(order, allowed_columns_set(table), "as order for", table)
+    return order
+
+
+# ========== PARSE QUERY STRING (1 lượt quét, không qua parse_qs) ==========
+def _fast_parse_qs(qs: str) -> Dict[str, str]:
+    """
+    Parse query string bằng 1 lượt str.find, trả dict phẳng (giá trị đầu thắng).
+    Nhanh hơn parse_qs: không bọc list quanh từng giá trị, và bỏ luôn bước
+    percent-decode khi chuỗi không chứa '%' hay '+'.
+    """
+    if not qs:
+        return {}
+    decode = None if ("%" not in qs and "+" not in qs) else unquote_plus
+    out: Dict[str, str] = {}
+    i, n = 0, len(qs)
+    while i < n:
+        amp = qs.find("&", i)
+        if amp < 0:
+            amp = n
+        eq = qs.find("=", i, amp)
+        if eq < 0:
+            k, v = qs[i:amp], ""
+        else:
+            k, v = qs[i:eq], qs[eq + 1:amp]
+        if decode is not None:
+            k, v = decode(k), decode(v)
+        if k and k not in out:
+            out[k] = v
+        i = amp + 1
+    return out
 
 
 # ========== FILTER DYNAMIC ==========
-def apply_filters(q, params: Dict[str, Any], table: str):
+# Các key dành riêng cho phân trang / chọn cột, không phải filter
+SKIP = frozenset(
+    {"select", "order", "desc", "limit", "offset", "count", "after", "after_col", "cursor", "stream", "nocache"}
+)
+
+# Bảng dispatch op -> tên method của query builder (tra O(1) thay vì if/elif)
+_OPS = {
+    "eq": "eq",
+    "ne": "neq",
+    "gt": "gt",
+    "gte": "gte",
+    "lt": "lt",
+    "lte": "lte",
+    "like": "like",
+    "ilike": "ilike",
+}
+
+
+@lru_cache(maxsize=1024)
+def _filter_plan(sig: tuple, table: str) -> tuple:
+    """
+    'Biên dịch' bộ key filter thành plan (key, op, col) memoize theo chữ ký
+    (tuple key đã sort): partition + validate cột chỉ chạy lần đầu mỗi shape,
+    request sau cùng shape chỉ còn bước apply.
+    """
+    allowed = allowed_columns_set(table)
+    plan = []
+    for k in sig:
+        if k in SKIP:
+            continue
+        # partition = 1 lượt quét C-level, thay cho cặp `in` + `split`
+        op, sep, col = k.partition("__")
+        if not sep:
+            op, col = "eq", k
+        # validate col (op lạ thì bỏ qua filter đó, giữ behavior cũ)
+        _check_column(col, allowed, "for table", table)
+        if op in _OPS or op == "in" or op == "is":
+            plan.append((k, op, col))
+    return tuple(plan)
+
+
+def apply_filters(q, params: Mapping[str, Any], table: str, _plan=_filter_plan, _ops_get=_OPS.get):
     """
     Filter động:
       ?status=DA_GIAO (mặc định eq)
@@ -163,42 +426,19 @@ def apply_filters(q, params: Dict[str, Any], table: str):
       ?gt__created_at=2025-01-01
       ?in__status=DA_GIAO,DANG_XU_LY
       ?is__field=null|true|false
-    Có validate cột theo schema.
+    Có validate cột theo schema (memoize trong _filter_plan).
+    _plan/_ops_get bind sẵn làm default arg: đọc local thay vì tra global
+    mỗi vòng lặp.
     """
-    skip = {"select", "order", "desc", "limit", "offset", "count"}
-    allowed = allowed_columns_set(table)
-
-    for k, v in params.items():
-        if k in skip:
-            continue
-        if "__" in k:
-            op, col = k.split("__", 1)
-        else:
-            op, col = "eq", k
-
-        # validate col
-        if col not in allowed and allowed:
-            raise HTTPException(status_code=400, detail=f"Column '{col}' is not allowed for table '{table}'")
-
-        if op == "in":
-            q = q.in_(col, [x for x in str(v).split(",") if x])
-        elif op == "eq":
-            q = q.eq(col, v)
-        elif op == "ne":
-            q = q.neq(col, v)
-        elif op == "gt":
-            q = q.gt(col, v)
-        elif op == "gte":
-            q = q.gte(col, v)
-        elif op == "lt":
-            q = q.lt(col, v)
-        elif op == "lte":
-            q = q.lte(col, v)
-        elif op == "like":
-            q = q.like(col, v)
-        elif op == "ilike":
-            q = q.ilike(col, v)
-        elif op == "is":
+    for k, op, col in _plan(tuple(sorted(params)), table):
+        v = params[k]
+        meth = _ops_get(op)
+        if meth:
+            q = getattr(q, meth)(col, v)
+        elif op == "in":
+            # filter/map chạy C-level, không dựng list trung gian như listcomp
+            q = q.in_(col, list(filter(None, map(str.strip, str(v).split(",")))))
+        else:  # op == "is"
             vv = str(v).lower()
             val = None if vv == "null" else True if vv == "true" else False if vv == "false" else v
             q = q.is_(col, val)
@@ -225,74 +465,263 @@ def meta_schema(table: str, request: Request):
     return {"table": t, "columns": schema, "count": len(schema)}
 
 
-# ========== FACTORY TẠO ENDPOINT /api/<table> ==========
-def make_table_endpoint(table: str) -> Callable:
-    async def endpoint(
-        request: Request,
-        select: str = Query("*", description="VD: *, hoặc id,name"),
-        order: Optional[str] = Query(None, description="VD: created_at"),
-        desc: bool = Query(True),
-        limit: int = Query(100, ge=1, le=500),
-        offset: int = Query(0, ge=0),
-        count: Optional[str] = Query(None, description="exact|planned|estimated"),
-    ):
-        check_api_key(request)
-        t = get_table_or_404(table)
-
-        # validate select
-        allowed = allowed_columns_set(t)
-        if select != "*" and allowed:
-            req_cols = [c.strip() for c in select.split(",") if c.strip()]
-            for c in req_cols:
-                if c not in allowed:
-                    raise HTTPException(status_code=400, detail=f"Column '{c}' not allowed in select for '{t}'")
-            select_clean = ",".join(req_cols)
+@app.post("/admin/reload-schema")
+def reload_schema(request: Request):
+    # Migrate DB xong gọi endpoint này để lần dùng kế tiếp fetch schema mới
+    check_api_key(request)
+    _SCHEMA_CACHE.clear()
+    allowed_columns_set.cache_clear()
+    _clean_select.cache_clear()
+    _check_order.cache_clear()
+    _filter_plan.cache_clear()
+    return {"ok": True}
+
+
+# ========== CURSOR PHÂN TRANG (opaque, stateless) ==========
+# Cursor = base64(json) giữ (cột, giá trị cuối trang); client chỉ việc gửi
+# lại nguyên chuỗi, server không phải giữ state phân trang nào
+def _encode_cursor(col: str, value: Any) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps({"c": col, "v": value})).decode()
+
+
+def _decode_cursor(cursor: str):
+    try:
+        doc = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(doc["c"]), doc["v"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# ========== STREAM JSON TỪNG DÒNG ==========
+def _stream_payload(meta: Dict[str, Any], rows: List[Dict[str, Any]]):
+    """
+    Encode response từng dòng một: không dựng cả chuỗi JSON to trong RAM
+    cạnh list data (đỡ ~1 bản copy lớn mỗi request, TTFB cũng thấp hơn).
+    """
+    yield orjson.dumps(meta)[:-1] + b',"data":['
+    first = True
+    for row in rows:
+        if first:
+            first = False
         else:
-            select_clean = select
+            yield b","
+        yield orjson.dumps(row)
+    yield b"]}"
+
+
+def _stream_ndjson(rows: List[Dict[str, Any]]):
+    """NDJSON: mỗi dòng 1 row, consumer xử lý được tới đâu đọc tới đó."""
+    for row in rows:
+        yield orjson.dumps(row) + b"\n"
+
+
+# ========== ROUTE CHUNG /api/{table} ==========
+# 1 route param hoá thay cho N closure + route object mỗi bảng: đỡ RAM,
+# startup/cold-start nhanh hơn; bảng được validate lúc request qua get_table_or_404
+@app.get("/api/{table}", name="Read table", description="Đọc 1 bảng trong danh sách TABLES")
+async def read_table(
+    table: str,
+    request: Request,
+    select: str = Query("*", description="VD: *, hoặc id,name"),
+    order: Optional[str] = Query(None, description="VD: created_at"),
+    desc: bool = Query(True),
+    limit: int = Query(100, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    after: Optional[str] = Query(
+        None,
+        description="Keyset pagination: giá trị after_col của dòng cuối trang trước (thay cho offset)",
+    ),
+    after_col: str = Query("id", description="Cột làm khoá keyset khi dùng after"),
+    cursor: Optional[str] = Query(
+        None,
+        description="Cursor opaque từ next_cursor của trang trước (thay cho after/after_col)",
+    ),
+    count: Optional[str] = Query(
+        None,
+        description="exact|planned|estimated (exact quét full bảng, bảng lớn nên dùng planned/estimated)",
+    ),
+    stream: Optional[str] = Query(
+        None,
+        description="Stream response từng dòng (limit lớn / row rộng): 1|json = JSON object, ndjson = 1 dòng / 1 row",
+    ),
+    nocache: bool = Query(False, description="Bỏ qua cache server, luôn query Supabase"),
+):
+    check_api_key(request)
+    t = get_table_or_404(table)
+    count = check_count_mode(count)
+
+    # Cache: bỏ qua khi client đòi dữ liệu tươi hoặc cần count chính xác
+    use_cache = (
+        RESP_TTL > 0
+        and not nocache
+        and stream is None
+        and count != "exact"
+        and request.headers.get("X-No-Cache") != "1"
+    )
+    # Parse query string đúng 1 lần, dùng chung cho cache key lẫn filter
+    params = _fast_parse_qs(request.url.query)
+
+    cache_key = ""
+    if use_cache:
+        # Serialize qua JSON cho không nhập nhằng, và key theo ĐỦ danh sách
+        # cặp (k, v) từ multidict: FastAPI resolve Query() param last-wins,
+        # nên key dựng từ dict first-wins sẽ gộp ?limit=3&limit=2 với
+        # ?limit=3 dù hai request chạy khác nhau
+        cache_key = t + "|" + orjson.dumps(sorted(request.query_params.multi_items())).decode()
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            body, etag = cached
+            return _json_response(request, body, etag, "HIT")
+        inflight = _INFLIGHT.get(cache_key)
+        if inflight is not None:
+            # Request y hệt đang chạy -> đợi chung kết quả (coalescing);
+            # shield để waiter bị cancel không kéo future chung theo
+            result = await asyncio.shield(inflight)
+            if result is not None:
+                body, etag = result
+                return _json_response(request, body, etag, "HIT")
+            # Leader bị cancel giữa chừng (client ngắt kết nối) -> không
+            # phải lỗi của mình, rơi xuống dưới tự query như leader mới
+
+    fut: Optional[asyncio.Future] = None
+    if use_cache:
+        fut = asyncio.get_running_loop().create_future()
+        _INFLIGHT[cache_key] = fut
 
-        try:
-            q = supabase.table(t).select(select_clean, count=count)
-            # apply filters
-            q = apply_filters(q, dict(request.query_params), t)
+    try:
+        # validate select (lần đầu có thể phải fetch schema -> đẩy ra thread)
+        allowed = await asyncio.to_thread(allowed_columns_set, t)
+        select_clean = _clean_select(t, select)
 
-            # validate order
+        try:
+            q = get_supabase().table(t).select(select_clean, count=count)
+            # apply filters (params đã parse sẵn ở trên)
+            q = apply_filters(q, params, t)
+
+            # cursor opaque chỉ là vỏ bọc của after/after_col
+            if cursor is not None:
+                after_col, after = _decode_cursor(cursor)
+
+            # keyset pagination: seek theo index thay vì bắt Postgres
+            # scan-rồi-bỏ `offset` dòng (offset sâu tốn O(offset))
+            if after is not None:
+                _check_column(after_col, allowed, "as keyset for", t)
+                if order is None:
+                    order = after_col
+                elif order != after_col:
+                    raise HTTPException(status_code=400, detail="order must equal after_col when using keyset pagination (after)")
+                q = q.lt(after_col, after) if desc else q.gt(after_col, after)
+
+            # validate order (memoize theo shape, xem _check_order)
             if order:
-                if allowed and order not in allowed:
-                    raise HTTPException(status_code=400, detail=f"Order by unknown column '{order}'")
-                q = q.order(order, desc=desc)
-
-            # range
-            q = q.range(offset, offset + max(0, limit - 1))
-            res = q.execute()
-            return {
+                q = q.order(_check_order(t, order), desc=desc)
+
+            # range (keyset thì bỏ offset, trang kế đi bằng after)
+            if after is not None:
+                q = q.range(0, max(0, limit - 1))
+            else:
+                q = q.range(offset, offset + max(0, limit - 1))
+            # q.execute() là I/O blocking (httpx sync) -> chạy trong threadpool
+            # để không ghim event loop trong lúc chờ Supabase trả lời
+            res = await asyncio.to_thread(q.execute)
+            if stream is not None:
+                if stream == "ndjson":
+                    return StreamingResponse(
+                        _stream_ndjson(res.data or []),
+                        media_type="application/x-ndjson",
+                    )
+                meta = {"table": t, "limit": limit, "offset": offset}
+                if count is not None:
+                    meta["count"] = res.count
+                return StreamingResponse(
+                    _stream_payload(meta, res.data or []),
+                    media_type="application/json",
+                )
+            payload = {
                 "table": t,
-                "count": res.count,
                 "data": res.data,
                 "limit": limit,
                 "offset": offset,
+                # Trang đầy (len == limit) thì nhiều khả năng còn dữ liệu;
+                # rẻ hơn nhiều so với bắt Postgres đếm cả bảng
+                "has_more": len(res.data or []) == limit,
             }
+            if count is not None:
+                payload["count"] = res.count
+            # Trả next_after/next_cursor cả ở trang offset đầu tiên (miễn là
+            # row có cột keyset) để client bootstrap được chuỗi keyset mà
+            # không phải tự đoán giá trị after khởi điểm; chỉ khi order
+            # trống hoặc trùng cột keyset — keyset mode ép order = after_col
+            # nên cursor theo order khác sẽ đổi thứ tự giữa chừng
+            rows = res.data or []
+            if after is not None or (
+                rows and after_col in rows[-1] and (order is None or order == after_col)
+            ):
+                last = rows[-1].get(after_col) if rows else None
+                payload["next_after"] = last
+                payload["next_cursor"] = _encode_cursor(after_col, last) if last is not None else None
         except HTTPException:
             raise
         except Exception as e:
-            traceback.print_exc()
+            log.exception("query failed for table %s", t)
             raise HTTPException(
                 status_code=status.HTTP_502_BAD_GATEWAY,
                 detail=f"{t}: {type(e).__name__}: {e}",
             )
 
-    endpoint.__name__ = f"read_{table}"
-    return endpoint
-
-
-# Đăng ký routes: /api/<table>
-for t in TABLES:
-    app.get(f"/api/{t}", name=f"Get {t}", description=f"Đọc bảng `{t}`")(make_table_endpoint(t))
+        if fut is not None:
+            # Cache luôn bytes đã serialize + ETag: hit sau đó khỏi encode
+            # JSON lẫn hash lại
+            body = orjson.dumps(payload)
+            etag = _make_etag(body)
+            _cache_put(cache_key, (body, etag))
+            if not fut.done():
+                fut.set_result((body, etag))
+            return _json_response(request, body, etag, "MISS")
+        return payload
+    except BaseException as e:
+        if fut is not None and not fut.done():
+            if isinstance(e, Exception):
+                fut.set_exception(e)
+                fut.exception()  # đánh dấu đã đọc, khỏi warning nếu không ai đợi
+            else:
+                # CancelledError/exit của leader không phải lỗi của waiter:
+                # trả sentinel None để họ tự chạy query
+                fut.set_result(None)
+        raise
+    finally:
+        if fut is not None:
+            _INFLIGHT.pop(cache_key, None)
+
+
+# ========== THREADPOOL LÚC KHỞI ĐỘNG ==========
+@app.on_event("startup")
+async def tune_threadpools():
+    # Mọi I/O Supabase đều chạy blocking trong threadpool (asyncio.to_thread
+    # cho query, AnyIO cho endpoint sync); default nhỏ nên DB chậm là nghẽn
+    # hàng đợi thread trước khi nghẽn DB
+    tokens = int(os.environ.get("THREADPOOL_TOKENS", "100"))
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=tokens))
+    anyio.to_thread.current_default_thread_limiter().total_tokens = tokens
+
+
+# ========== WARM SCHEMA CACHE LÚC KHỞI ĐỘNG ==========
+@app.on_event("startup")
+async def warm_schemas():
+    # Prefetch schema mọi bảng song song để request đầu tiên của từng bảng
+    # không phải chịu round-trip lạnh; tắt bằng WARM_SCHEMAS=0 nếu deploy
+    # cần start thật nhanh
+    if os.environ.get("WARM_SCHEMAS", "1") != "1":
+        return
+    # PostgREST không expose information_schema cho anon key nên không gom
+    # được thành 1 câu SQL; gom thành 1 batch probe song song là mức tốt nhất
+    await asyncio.gather(*(asyncio.to_thread(get_schema, t) for t in TABLES))
 
 
 # ========== GLOBAL ERROR HANDLER (gọn JSON) ==========
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "ok": False,